@@ -11,10 +11,10 @@ from tqdm import tqdm
 from torch import nn
 from torch import optim
 from collections import OrderedDict
-from torch.autograd import Variable
 from torch.utils.data import DataLoader
 from torch.optim import lr_scheduler
 from torchvision.models.resnet import resnet18
+from torchvision.transforms import v2
 from mean_variance_loss import MeanVarianceLoss
 import cv2
 
@@ -28,6 +28,9 @@ random.seed(2019)
 np.random.seed(2019)
 torch.manual_seed(2019)
 
+# age classes as a CUDA tensor, created once in main()
+AGE_RANGE = None
+
 
 def ResNet18(num_classes):
 
@@ -40,141 +43,143 @@ def ResNet18(num_classes):
     return model
 
 
-def train(train_loader, model, criterion1, criterion2, optimizer, epoch, result_directory):
+def expected_age(logits, age_range):
+
+    # softmax followed by a matrix-vector product, the probabilities are not scaled and summed separately
+    return torch.softmax(logits, dim=1) @ age_range
+
+
+def train(train_loader, model, criterion1, criterion2, optimizer, scaler, epoch, log_file):
 
     model.train()
     running_loss = 0.
     running_mean_loss = 0.
     running_variance_loss = 0.
     running_softmax_loss = 0.
-    interval = 1
+    interval = min(50, len(train_loader))
     for i, sample in enumerate(train_loader):
-        images = sample['image'].cuda()
-        labels = sample['label'].cuda()
-        output = model(images)
+        images = sample['image'].to('cuda', memory_format=torch.channels_last, non_blocking=True)
+        labels = sample['label'].cuda(non_blocking=True)
+        with torch.cuda.amp.autocast():
+            output = model(images)
+        # losses are computed in FP32 to keep the mean/variance terms stable
+        output = output.float()
         mean_loss, variance_loss = criterion1(output, labels)
         softmax_loss = criterion2(output, labels)
         loss = mean_loss + variance_loss + softmax_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        running_loss += loss.data
-        running_softmax_loss += softmax_loss.data
-        running_mean_loss += mean_loss.data
-        running_variance_loss += variance_loss.data
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        running_loss += loss.detach()
+        running_softmax_loss += softmax_loss.detach()
+        running_mean_loss += mean_loss.detach()
+        running_variance_loss += variance_loss.detach()
         if (i + 1) % interval == 0:
-            print('[%d, %5d] mean_loss: %.3f, variance_loss: %.3f, softmax_loss: %.3f, loss: %.3f'
-                  % (epoch, i, running_mean_loss / interval,
-                     running_variance_loss / interval,
-                     running_softmax_loss / interval,
-                     running_loss / interval))
-            with open(os.path.join(result_directory, 'log'), 'a') as f:
-                f.write('[%d, %5d] mean_loss: %.3f, variance_loss: %.3f, softmax_loss: %.3f, loss: %.3f\n'
-                        % (epoch, i, running_mean_loss / interval,
-                           running_variance_loss / interval,
-                           running_softmax_loss / interval,
-                           running_loss / interval))
+            # a single device-to-host copy per logged interval
+            losses = torch.stack([running_mean_loss, running_variance_loss,
+                                  running_softmax_loss, running_loss]).div(interval).tolist()
+            line = ('[%d, %5d] mean_loss: %.3f, variance_loss: %.3f, softmax_loss: %.3f, loss: %.3f'
+                    % (epoch, i, *losses))
+            print(line)
+            log_file.write(line + '\n')
             running_loss = 0.
             running_mean_loss = 0.
             running_variance_loss = 0.
             running_softmax_loss = 0.
 
 
-def train_softmax(train_loader, model, criterion2, optimizer, epoch, result_directory):
+def train_softmax(train_loader, model, criterion2, optimizer, scaler, epoch, log_file):
 
     model.train()
     running_loss = 0.
     running_softmax_loss = 0.
-    interval = 1
+    interval = min(50, len(train_loader))
     for i, sample in enumerate(train_loader):
-        images = sample['image'].cuda()
-        labels = sample['label'].cuda()
-        output = model(images)
-        loss = criterion2(output, labels)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        running_loss += loss.data
+        images = sample['image'].to('cuda', memory_format=torch.channels_last, non_blocking=True)
+        labels = sample['label'].cuda(non_blocking=True)
+        with torch.cuda.amp.autocast():
+            output = model(images)
+        loss = criterion2(output.float(), labels)
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        running_loss += loss.detach()
         if (i + 1) % interval == 0:
-            print('[%d, %5d] loss: %.3f'
-                  % (epoch, i, running_loss / interval))
-            with open(os.path.join(result_directory, 'log'), 'a') as f:
-                f.write('[%d, %5d] loss: %.3f\n'
-                        % (epoch, i, running_loss / interval))
+            line = '[%d, %5d] loss: %.3f' % (epoch, i, running_loss.item() / interval)
+            print(line)
+            log_file.write(line + '\n')
             running_loss = 0.
 
 
 def evaluate(val_loader, model, criterion1, criterion2):
     model.cuda()
     model.eval()
-    loss_val = 0.
-    mean_loss_val = 0.
-    variance_loss_val = 0.
-    softmax_loss_val = 0.
-    mae = 0.
+    loss_val = torch.zeros((), device='cuda')
+    mean_loss_val = torch.zeros((), device='cuda')
+    variance_loss_val = torch.zeros((), device='cuda')
+    softmax_loss_val = torch.zeros((), device='cuda')
+    mae = torch.zeros((), device='cuda')
     with torch.no_grad():
         for i, sample in enumerate(val_loader):
-            image = sample['image'].cuda()
-            label = sample['label'].cuda()
-            output = model(image)
+            image = sample['image'].to('cuda', memory_format=torch.channels_last, non_blocking=True)
+            label = sample['label'].cuda(non_blocking=True)
+            with torch.cuda.amp.autocast():
+                output = model(image)
+            output = output.float()
             mean_loss, variance_loss = criterion1(output, label)
             softmax_loss = criterion2(output, label)
             loss = mean_loss + variance_loss + softmax_loss
-            loss_val += loss.data
-            mean_loss_val += mean_loss.data
-            variance_loss_val += variance_loss.data
-            softmax_loss_val += softmax_loss.data
-            m = nn.Softmax(dim=1)
-            output_softmax = m(output)
-            a = torch.arange(START_AGE, END_AGE + 1, dtype=torch.float32).cuda()
-            mean = (output_softmax * a).sum(1, keepdim=True).cpu().data.numpy()
-            pred = np.around(mean)
-            mae += np.absolute(pred - sample['label'].cpu().data.numpy())
-    return mean_loss_val / len(val_loader),\
-        variance_loss_val / len(val_loader),\
-        softmax_loss_val / len(val_loader),\
-        loss_val / len(val_loader),\
-        mae / len(val_loader)
+            # losses are batch means, weight them so the epoch value is a per-sample mean
+            n = image.size(0)
+            loss_val += loss.detach() * n
+            mean_loss_val += mean_loss.detach() * n
+            variance_loss_val += variance_loss.detach() * n
+            softmax_loss_val += softmax_loss.detach() * n
+            pred = torch.round(expected_age(output, AGE_RANGE))
+            mae += (pred - label.float()).abs().sum()
+    num = len(val_loader.dataset)
+    # a single device-to-host copy for all the epoch metrics
+    return tuple(torch.stack([mean_loss_val, variance_loss_val, softmax_loss_val,
+                              loss_val, mae]).div(num).tolist())
 
 
 def evaluate_softmax(val_loader, model, criterion2):
     model.cuda()
     model.eval()
-    loss_val = 0.
+    loss_val = torch.zeros((), device='cuda')
     softmax_loss_val = 0.
-    mae = 0.
+    mae = torch.zeros((), device='cuda')
     with torch.no_grad():
         for i, sample in enumerate(val_loader):
-            image = sample['image'].cuda()
-            label = sample['label'].cuda()
-            output = model(image)
+            image = sample['image'].to('cuda', memory_format=torch.channels_last, non_blocking=True)
+            label = sample['label'].cuda(non_blocking=True)
+            with torch.cuda.amp.autocast():
+                output = model(image)
+            output = output.float()
             loss = criterion2(output, label)
-            loss_val += loss.data
-            m = nn.Softmax(dim=1)
-            output_softmax = m(output)
-            a = torch.arange(START_AGE, END_AGE + 1, dtype=torch.float32).cuda()
-            mean = (output_softmax * a).sum(1, keepdim=True).cpu().data.numpy()
-            pred = np.around(mean)
-            mae += np.absolute(pred - sample['label'].cpu().data.numpy())
-    return loss_val / len(val_loader), mae / len(val_loader)
+            loss_val += loss.detach() * image.size(0)
+            pred = torch.round(expected_age(output, AGE_RANGE))
+            mae += (pred - label.float()).abs().sum()
+    num = len(val_loader.dataset)
+    return tuple(torch.stack([loss_val, mae]).div(num).tolist())
 
 
 def test(test_loader, model):
     model.cuda()
     model.eval()
-    mae = 0.
+    mae = torch.zeros((), device='cuda')
     with torch.no_grad():
         for i, sample in enumerate(test_loader):
-            image = sample['image'].cuda()
-            label = sample['label'].cuda()
-            output = model(image)
-            m = nn.Softmax(dim=1)
-            output = m(output)
-            a = torch.arange(START_AGE, END_AGE + 1, dtype=torch.float32).cuda()
-            mean = (output * a).sum(1, keepdim=True).cpu().data.numpy()
-            pred = np.around(mean)
-            mae += np.absolute(pred - sample['label'].cpu().data.numpy())
-    return mae / len(test_loader)
+            image = sample['image'].to('cuda', memory_format=torch.channels_last, non_blocking=True)
+            label = sample['label'].cuda(non_blocking=True)
+            with torch.cuda.amp.autocast():
+                output = model(image)
+            output = output.float()
+            pred = torch.round(expected_age(output, AGE_RANGE))
+            mae += (pred - label.float()).abs().sum()
+    return (mae / len(test_loader.dataset)).item()
 
 
 def predict(model, image):
@@ -185,11 +190,8 @@ def predict(model, image):
         image = np.transpose(image, (2,0,1))
         img = torch.from_numpy(image).cuda()
         output = model(img[None])
-        m = nn.Softmax(dim=1)
-        output = m(output)
-        a = torch.arange(START_AGE, END_AGE + 1, dtype=torch.float32).cuda()
-        mean = (output * a).sum(1, keepdim=True).cpu().data.numpy()
-        pred = np.around(mean)[0][0]
+        mean = expected_age(output, AGE_RANGE).cpu().numpy()
+        pred = np.around(mean)[0]
     return pred
 
 
@@ -205,7 +207,7 @@ def get_image_list(image_directory, leave_sub, validation_rate):
         else:
             train_val_list.append(filepath)
     num = len(train_val_list)
-    index_val = np.random.choice(num, int(num * validation_rate), replace=False)
+    index_val = set(np.random.choice(num, int(num * validation_rate), replace=False).tolist())
     train_list = []
     val_list = []
     for i, fp in enumerate(train_val_list):
@@ -221,6 +223,7 @@ def get_args():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', '--batch_size', type=int, default=16)
+    parser.add_argument('-eb', '--eval_batch_size', type=int, default=64)
     parser.add_argument('-i', '--image_directory', type=str)
     parser.add_argument('-ls', '--leave_subject', type=int)
     parser.add_argument('-lr', '--learning_rate', type=float)
@@ -230,94 +233,109 @@ def get_args():
     parser.add_argument('-pi', '--pred_image', type=str, default=None)
     parser.add_argument('-pm', '--pred_model', type=str, default=None)
     parser.add_argument('-loss', '--is_mean_variance', action='store_true')
+    parser.add_argument('-c', '--compile', action='store_true')
     return parser.parse_args()
 
 
 def main():
     
+    global AGE_RANGE
     args = get_args()
+    AGE_RANGE = torch.arange(START_AGE, END_AGE + 1, dtype=torch.float32, device='cuda')
+    # input shapes are fixed at 224x224, so let cuDNN pick the fastest conv algorithms
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     if args.epoch > 0:
         batch_size = args.batch_size
+        num_workers = min(8, os.cpu_count() or 1)
         if args.result_directory is not None:
             if not os.path.exists(args.result_directory):
                 os.mkdir(args.result_directory)
 
         train_filepath_list, val_filepath_list, test_filepath_list\
             = get_image_list(args.image_directory, args.leave_subject, VALIDATION_RATE)
-        transforms_train = torchvision.transforms.Compose([
-            torchvision.transforms.ToPILImage(),
-            torchvision.transforms.RandomApply(
-                [torchvision.transforms.RandomAffine(degrees=10, shear=16),
-                 torchvision.transforms.RandomHorizontalFlip(p=1.0),
+        transforms_train = v2.Compose([
+            v2.ToImage(),
+            v2.RandomApply(
+                [v2.RandomAffine(degrees=10, shear=16),
+                 v2.RandomHorizontalFlip(p=1.0),
                 ], p=0.5),
-            torchvision.transforms.Resize((256, 256)),
-            torchvision.transforms.RandomCrop((224, 224)),
-            torchvision.transforms.ToTensor()
+            v2.Resize((256, 256), antialias=True),
+            v2.RandomCrop((224, 224)),
+            v2.ToDtype(torch.float32, scale=True)
         ])
         train_gen = FaceDataset(train_filepath_list, transforms_train)
-        train_loader = DataLoader(train_gen, batch_size=batch_size, shuffle=True, pin_memory=True, num_workers=8)
+        train_loader = DataLoader(train_gen, batch_size=batch_size, shuffle=True, pin_memory=True,
+                                  num_workers=num_workers, persistent_workers=True)
 
-        transforms = torchvision.transforms.Compose([
-            torchvision.transforms.ToPILImage(),
-            torchvision.transforms.Resize((224, 224)),
-            torchvision.transforms.ToTensor()
+        transforms = v2.Compose([
+            v2.ToImage(),
+            v2.Resize((224, 224), antialias=True),
+            v2.ToDtype(torch.float32, scale=True)
         ])
         val_gen = FaceDataset(val_filepath_list, transforms)
-        val_loader = DataLoader(val_gen, batch_size=1, shuffle=False, pin_memory=True, num_workers=8)
+        val_loader = DataLoader(val_gen, batch_size=args.eval_batch_size, shuffle=False, pin_memory=True,
+                                num_workers=num_workers, persistent_workers=True)
 
         test_gen = FaceDataset(test_filepath_list, transforms)
-        test_loader = DataLoader(test_gen, batch_size=1, shuffle=False, pin_memory=True, num_workers=8)
+        test_loader = DataLoader(test_gen, batch_size=args.eval_batch_size, shuffle=False, pin_memory=True,
+                                num_workers=num_workers, persistent_workers=True)
 
         model = ResNet18(END_AGE - START_AGE + 1)
         model.cuda()
+        model = model.to(memory_format=torch.channels_last)
+        # checkpoints are saved from model so their keys have no compile wrapper prefix
+        compiled_model = model
+        if args.compile:
+            if torch.cuda.get_device_capability() >= (7, 0):
+                compiled_model = torch.compile(model)
+            else:
+                print('torch.compile needs CUDA compute capability 7.0+, running eagerly')
 
-        optimizer = optim.Adam(model.parameters(), lr = args.learning_rate)
+        optimizer = optim.Adam(model.parameters(), lr = args.learning_rate, foreach=True)
         criterion1 = MeanVarianceLoss(LAMBDA_1, LAMBDA_2, START_AGE, END_AGE).cuda()
         criterion2 = torch.nn.CrossEntropyLoss().cuda()
         scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[80], gamma=0.1)
-
-
-        best_val_mae = np.inf
-        best_val_loss = np.inf
-        best_mae_epoch = -1
-        best_loss_epoch = -1
-        for epoch in range(args.epoch):
-            scheduler.step(epoch)
-            if args.is_mean_variance:
-                train(train_loader, model, criterion1, criterion2, optimizer, epoch, args.result_directory)
-                mean_loss, variance_loss, softmax_loss, loss_val, mae = evaluate(val_loader, model, criterion1, criterion2)
-                print('epoch: %d, mean_loss: %.3f, variance_loss: %.3f, softmax_loss: %.3f, loss: %.3f, mae: %3f' %
-                      (epoch, mean_loss, variance_loss, softmax_loss, loss_val, mae))
-                with open(os.path.join(args.result_directory, 'log'), 'a') as f:
-                    f.write('epoch: %d, mean_loss: %.3f, variance_loss: %.3f, softmax_loss: %.3f, loss: %.3f, mae: %3f\n' %
-                        (epoch, mean_loss, variance_loss, softmax_loss, loss_val, mae))
-            else:
-                train_softmax(train_loader, model, criterion2, optimizer, epoch, args.result_directory)
-                loss_val, mae = evaluate_softmax(val_loader, model, criterion2)
-                print('epoch: %d, loss: %.3f, mae: %3f' % (epoch, loss_val, mae))
-                with open(os.path.join(args.result_directory, 'log'), 'a') as f:
-                    f.write('epoch: %d, loss: %.3f, mae: %3f\n' % (epoch, loss_val, mae))
-
-            mae_test = test(test_loader, model)
-            print('epoch: %d, test_mae: %3f' % (epoch, mae_test))
-            with open(os.path.join(args.result_directory, 'log'), 'a') as f:
-                f.write('epoch: %d, mae_test: %3f\n' % (epoch, mae_test))
-            if best_val_mae > mae:
-                best_val_mae = mae
-                best_mae_epoch = epoch
-                torch.save(model.state_dict(), os.path.join(args.result_directory, "model_best_mae"))
-            if best_val_loss > loss_val:
-                best_val_loss = loss_val
-                best_loss_epoch = epoch
-                torch.save(model.state_dict(), os.path.join(args.result_directory, "model_best_loss"))            
-        with open(os.path.join(args.result_directory, 'log'), 'a') as f:
-            f.write('best_loss_epoch: %d, best_val_loss: %f, best_mae_epoch: %d, best_val_mae: %f\n'
-                    % (best_loss_epoch, best_val_loss, best_mae_epoch, best_val_mae))
+        scaler = torch.cuda.amp.GradScaler()
+        with open(os.path.join(args.result_directory, 'log'), 'a', buffering=1) as log_file:
+            best_val_mae = np.inf
+            best_val_loss = np.inf
+            best_mae_epoch = -1
+            best_loss_epoch = -1
+            for epoch in range(args.epoch):
+                if args.is_mean_variance:
+                    train(train_loader, compiled_model, criterion1, criterion2, optimizer, scaler, epoch, log_file)
+                    mean_loss, variance_loss, softmax_loss, loss_val, mae = evaluate(val_loader, compiled_model, criterion1, criterion2)
+                    print('epoch: %d, mean_loss: %.3f, variance_loss: %.3f, softmax_loss: %.3f, loss: %.3f, mae: %3f' %
+                          (epoch, mean_loss, variance_loss, softmax_loss, loss_val, mae))
+                    log_file.write('epoch: %d, mean_loss: %.3f, variance_loss: %.3f, softmax_loss: %.3f, loss: %.3f, mae: %3f\n' %
+                                   (epoch, mean_loss, variance_loss, softmax_loss, loss_val, mae))
+                else:
+                    train_softmax(train_loader, compiled_model, criterion2, optimizer, scaler, epoch, log_file)
+                    loss_val, mae = evaluate_softmax(val_loader, compiled_model, criterion2)
+                    print('epoch: %d, loss: %.3f, mae: %3f' % (epoch, loss_val, mae))
+                    log_file.write('epoch: %d, loss: %.3f, mae: %3f\n' % (epoch, loss_val, mae))
+                scheduler.step()
+
+                mae_test = test(test_loader, compiled_model)
+                print('epoch: %d, test_mae: %3f' % (epoch, mae_test))
+                log_file.write('epoch: %d, mae_test: %3f\n' % (epoch, mae_test))
+                if best_val_mae > mae:
+                    best_val_mae = mae
+                    best_mae_epoch = epoch
+                    torch.save(model.state_dict(), os.path.join(args.result_directory, "model_best_mae"))
+                if best_val_loss > loss_val:
+                    best_val_loss = loss_val
+                    best_loss_epoch = epoch
+                    torch.save(model.state_dict(), os.path.join(args.result_directory, "model_best_loss"))
+            log_file.write('best_loss_epoch: %d, best_val_loss: %f, best_mae_epoch: %d, best_val_mae: %f\n'
+                           % (best_loss_epoch, best_val_loss, best_mae_epoch, best_val_mae))
         print('best_loss_epoch: %d, best_val_loss: %f, best_mae_epoch: %d, best_val_mae: %f'
               % (best_loss_epoch, best_val_loss, best_mae_epoch, best_val_mae))
 
     if args.pred_image and args.pred_model:
-        model = ResNet34(END_AGE - START_AGE + 1)
+        model = ResNet18(END_AGE - START_AGE + 1)
         model.cuda()
         img = cv2.imread(args.pred_image)
         resized_img = cv2.resize(img, (224, 224))
@@ -12,15 +12,16 @@ class MeanVarianceLoss(nn.Module):
         self.lambda_2 = lambda_2
         self.start_age = start_age
         self.end_age = end_age
+        self.register_buffer('age_range', torch.arange(start_age, end_age + 1, dtype=torch.float32))
 
     def forward(self, input, target):
 
         N = input.size()[0]
-        target = target.type(torch.FloatTensor).cuda()
+        target = target.float()
         m = nn.Softmax(dim=1)
         p = m(input)
         # mean loss
-        a = torch.arange(self.start_age, self.end_age + 1, dtype=torch.float32).cuda()
+        a = self.age_range
         mean = torch.squeeze((p * a).sum(1, keepdim=True), dim=1)
         mse = (mean - target)**2
         mean_loss = mse.mean() / 2.0